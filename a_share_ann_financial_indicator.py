@@ -2,12 +2,12 @@ __author__ = 'Lingsong Zeng'
 
 from datetime import datetime
 from bisect import bisect
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
 import os
 from function.read_data_config import ReadConfig
 from function.read_index_columns import ReadIndex
+from factor_utils import read_index, read_sql_stream, write_factor, write_factors
 
 
 class AnnFinancialIndicator:
@@ -56,13 +56,22 @@ class AnnFinancialIndicator:
 
     """
 
-    def __init__(self):
-        """Initialize the class"""
+    def __init__(self, index: list = None, column: list = None):
+        """
+        Initialize the class
+        :param index: list, the date list constructed before, read by ReadIndex if not given
+        :param column: list, the stock list constructed before, read by ReadIndex if not given
+        Note:
+            pass index and column read once when running several classes together, so they are not read again
+        """
 
         # initialize parameters we gonna use later
-        ri = ReadIndex()
-        self.index = ri.read_index()     # For the date list we constructed before
-        self.column = ri.read_columns()  # For the stock list we constructed before
+        if index is None or column is None:
+            ri = ReadIndex()
+            index = ri.read_index() if index is None else index
+            column = ri.read_columns() if column is None else column
+        self.index = index    # For the date list we constructed before
+        self.column = column  # For the stock list we constructed before
 
         rc = ReadConfig()
         self.db = rc.read_wind_mysql()
@@ -82,6 +91,10 @@ class AnnFinancialIndicator:
                               'S_FA_YOYEBT', 'NET_PROFIT_YOY']
 
         self.factor_name_str = ', '.join(self.target_column)  # transfer factor names to str for sql
+        self.season = ['0331', '0630', '0930', '1231']  # season i is stored in '{factor}_{i+1}.hdf5'
+        # path of the local file of each factor and season, self.data_path is already absolute
+        self.factor_path = {(factor, i): os.path.join(self.data_path, '{}_{}.hdf5'.format(factor, i+1))
+                            for factor in self.target_column for i in range(len(self.season))}
 
     def read_data(self, begin_date: str = '20160101') -> pd.DataFrame:
         """
@@ -96,10 +109,12 @@ class AnnFinancialIndicator:
         sql = """
         SELECT S_INFO_WINDCODE, left(REPORT_PERIOD, 4) as 'YEAR', right(REPORT_PERIOD, 4) as 'SEASON', {}
         FROM wind.ASHAREANNFINANCIALINDICATOR
-        WHERE REPORT_PERIOD >= {};
-        """.format(self.factor_name_str, begin_date)
+        WHERE REPORT_PERIOD >= %s
+        ORDER BY S_INFO_WINDCODE, REPORT_PERIOD, ANN_DT;
+        """.format(self.factor_name_str)
 
-        data = pd.read_sql(sql, self.db)
+        data = read_sql_stream(sql, self.db, params=(begin_date,))
+        data['S_INFO_WINDCODE'] = data['S_INFO_WINDCODE'].astype('category')  # store each stock code only once
         end = datetime.now()
         print("Finished reading data from server, spend:", end - begin)
         return data
@@ -112,57 +127,73 @@ class AnnFinancialIndicator:
         :return: object, corresponding factor data stored in local
         """
 
-        return pd.read_hdf(os.path.abspath(os.path.join(self.data_path, '{}_{}.hdf5'.format(factor, i+1))), key=factor)
+        return pd.read_hdf(self.factor_path[(factor, i)], key=factor)
 
-    def rewrite_data(self):
-        """Split data into 34 tables by factors"""
+    def read_exist_index(self, factor: str, i: int) -> list:
+        """
+        Read only the dates of exist wind.ASHAREANNFINANCIALINDICATOR data of a factor from local
+        :param factor: str
+        :param i: int, season == i + 1
+        :return: list, dates stored in local
+        """
 
-        financial_indicator = self.read_data()  # this will pull data after 20160101 as default
-        financial_indicator.sort_values(['SEASON', 'S_INFO_WINDCODE', 'YEAR'], inplace=True)
-        begin = datetime.now()
+        return read_index(self.factor_path[(factor, i)], factor)
+
+    def split_by_season(self, financial_indicator: pd.DataFrame) -> dict:
+        """
+        Assign every report to the first date of its year and split data by season
+        :param financial_indicator: pd.DataFrame, data from read_data
+        :return: dict, {season: DataFrame of this season indexed by (DATE, S_INFO_WINDCODE)} for season in self.season
+        """
+
+        # find the first date in the year of each report, the value will be assigned to this date
+        # there are only a few distinct years, so we look them up once instead of for every record
+        year_to_date = {year: self.index[bisect(self.index, '{}0101'.format(year))]
+                        for year in financial_indicator.YEAR.unique()}
+        financial_indicator['DATE'] = financial_indicator.YEAR.map(year_to_date)
+
+        # keep the latest announcement if one stock reports more than once in the same year
+        return {s: financial_indicator[financial_indicator.SEASON == s].drop_duplicates(
+            ['S_INFO_WINDCODE', 'DATE'], keep='last').set_index(['DATE', 'S_INFO_WINDCODE']) for s in self.season}
 
-        main_dict = {s: {factor: {} for factor in self.target_column} for s in financial_indicator.SEASON.unique()}
-        # season_list = [ {'S_FA_EPS_DILUTED': {}, 'S_FA_EPS_BASIC': {}, ...}  -> season_dict x4 ]
+    def build_table(self, season_data: pd.DataFrame, factor: str, index: list) -> pd.DataFrame:
+        """
+        Build the table of one factor in one season, a reported value is filled forward until the next report
+        :param season_data: pd.DataFrame, data of one season from split_by_season
+        :param factor: str
+        :param index: list, dates of the table
+        :return: pd.DataFrame, index -> index, columns -> self.column
+        """
 
-        data_iter = financial_indicator.itertuples()
-        pre_record = next(data_iter)
-        stock_dict = {factor: {} for factor in self.target_column}
+        date_pos = pd.Index(index).get_indexer(season_data.index.get_level_values('DATE'))
+        code_pos = pd.Index(self.column).get_indexer(season_data.index.get_level_values('S_INFO_WINDCODE'))
+        found = (date_pos >= 0) & (code_pos >= 0)  # drop reports out of the table
+        date_pos, code_pos = date_pos[found], code_pos[found]
 
-        for record in data_iter:
+        value = np.full((len(index), len(self.column)), np.nan)
+        value[date_pos, code_pos] = season_data[factor].values[found]
 
-            code = pre_record.S_INFO_WINDCODE
-            year = pre_record.YEAR
-            date = self.index[bisect(self.index, '{}0101'.format(year))]  # find the first date in this year
+        # row of the latest report for every cell (-1 if there is no report yet), got by a cumulative max along dates.
+        # Taking the value at that row fills a report forward, and a reported NaN stays NaN until the next report
+        latest = np.full(value.shape, -1)
+        latest[date_pos, code_pos] = date_pos
+        latest = np.maximum.accumulate(latest, axis=0)
+        value = np.where(latest >= 0, value[latest, np.arange(len(self.column))], np.nan)
 
-            for factor in self.target_column:
-                value = getattr(pre_record, factor)
-                if pd.isna(value):  # if value is NaN, we assign value as 'NA' to avoid be overwritten later
-                    value = 'NA'
-                stock_dict[factor][date] = value  # assign value to first date of the year
-
-            if code != record.S_INFO_WINDCODE:
-                for factor in self.target_column:
-                    main_dict[pre_record.SEASON][factor][code] = stock_dict[factor].copy()
-                    stock_dict[factor].clear()
-
-            pre_record = record
-
-        code = pre_record.S_INFO_WINDCODE
-        year = pre_record.YEAR
-        date = self.index[bisect(self.index, '{}0101'.format(year))]  # find the first date in this year
-
-        for factor in self.target_column:
-            value = getattr(pre_record, factor)
-            if pd.isna(value):  # if value is NaN, we assign value as 'NA' to avoid be overwritten later
-                value = 'NA'
-            stock_dict[factor][date] = value  # assign value to first date of the year
-            main_dict[pre_record.SEASON][factor][code] = stock_dict[factor].copy()
-
-        for i, s in enumerate(financial_indicator.SEASON.unique()):  # ['0331', '0630', '0930', '1231']
-            for factor in tqdm(self.target_column):
-                df = pd.DataFrame(main_dict[s][factor], index=self.index, columns=self.column).fillna(method='ffill')
-                df.replace('NA', np.nan, inplace=True)  # replace 'NA' by NaN
-                df.to_hdf(os.path.abspath(os.path.join(self.data_path, '{}_{}.hdf5'.format(factor, i+1))), key=factor)
+        return pd.DataFrame(value, index=index, columns=self.column)
+
+    def rewrite_data(self):
+        """Split data into 34 tables by factors"""
+
+        financial_indicator = self.read_data()  # this will pull data after 20160101 as default
+        begin = datetime.now()
+        season_data = self.split_by_season(financial_indicator)
+
+        # tables are built here one at a time as workers become free, and written to hdf5 files in parallel
+        jobs = ((self.build_table(season_data[s], factor, self.index), self.factor_path[(factor, i)], factor)
+                for i, s in enumerate(self.season)  # ['0331', '0630', '0930', '1231']
+                for factor in self.target_column)
+        write_factors(jobs, len(self.season) * len(self.target_column))
 
         end = datetime.now()
         print("Finished rewriting data, spend:", end - begin)
@@ -173,63 +204,27 @@ class AnnFinancialIndicator:
         Note:
             1. if there is no new data to update, we end the function directly
             2. we start reading from the first date of new data, so we do not pull superfluous data from database
+            3. only the index of one table is read to find new dates; the other tables still have to be read in full,
+               since fixed format tables cannot be appended in place (see factor_utils.read_index)
         """
 
-        s_fa_eps_diluted = self.read_exist_data('S_FA_EPS_DILUTED', 0)  # pick one to compare if update is needed
-        new_date = sorted(list(set(self.index) - set(s_fa_eps_diluted.index)))
+        s_fa_eps_diluted = self.read_exist_index('S_FA_EPS_DILUTED', 0)  # pick one to compare if update is needed
+        new_date = pd.Index(self.index).difference(s_fa_eps_diluted).sort_values().tolist()
 
         if len(new_date) == 0:  # new_date == [] means there is no new data to update, so we end the function
             print("Data is already updated!")
             return None  # function ends here
 
         financial_indicator = self.read_data(new_date[0])  # start reading from the first date in new_date
-        financial_indicator.sort_values(['S_INFO_WINDCODE', 'YEAR'], inplace=True)
         begin = datetime.now()
+        season_data = self.split_by_season(financial_indicator)
 
-        main_dict = {s: {factor: {} for factor in self.target_column} for s in financial_indicator.SEASON.unique()}
-        # season_list = [ {'S_FA_EPS_DILUTED': {}, 'S_FA_EPS_BASIC': {}, ...}  -> season_dict x4 ]
-
-        data_iter = financial_indicator.itertuples()
-        pre_record = next(data_iter)
-        stock_dict = {factor: {} for factor in self.target_column}
-
-        for record in data_iter:
-
-            code = pre_record.S_INFO_WINDCODE
-            year = pre_record.YEAR
-            date = self.index[bisect(self.index, '{}0101'.format(year))]  # find the first date in this year
-
-            for factor in self.target_column:
-                value = getattr(pre_record, factor)
-                if pd.isna(value):  # if value is NaN, we assign value as 'NA' to avoid be overwritten later
-                    value = 'NA'
-                stock_dict[factor][date] = value  # assign value to first date of the year
-
-            if code != record.S_INFO_WINDCODE:
-                for factor in self.target_column:
-                    main_dict[pre_record.SEASON][factor][code] = stock_dict[factor].copy()
-                    stock_dict[factor].clear()
-
-            pre_record = record
-
-        code = pre_record.S_INFO_WINDCODE
-        year = pre_record.YEAR
-        date = self.index[bisect(self.index, '{}0101'.format(year))]  # find the first date in this year
-
-        for factor in self.target_column:
-            value = getattr(pre_record, factor)
-            if pd.isna(value):  # if value is NaN, we assign value as 'NA' to avoid be overwritten later
-                value = 'NA'
-            stock_dict[factor][date] = value  # assign value to first date of the year
-            main_dict[pre_record.SEASON][factor][code] = stock_dict[factor].copy()
-
-        for i, s in enumerate(financial_indicator.SEASON.unique()):
+        for i, s in enumerate(self.season):  # ['0331', '0630', '0930', '1231']
             for factor in self.target_column:
                 exist_data = self.read_exist_data(factor, i)
-                df = pd.DataFrame(main_dict[s][factor], index=new_date, columns=self.column).fillna(method='ffill')
-                df.replace('NA', np.nan, inplace=True)  # replace 'NA' by NaN
-                df = exist_data.append(df)
-                df.to_hdf(os.path.abspath(os.path.join(self.data_path, '{}_{}.hdf5'.format(factor, i+1))), key=factor)
+                df = self.build_table(season_data[s], factor, new_date)
+                df = pd.concat([exist_data, df], copy=False)
+                write_factor(df, self.factor_path[(factor, i)], factor)
 
         end = datetime.now()
         print("Finished updating data, spend:", end - begin)
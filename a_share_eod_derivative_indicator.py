@@ -6,6 +6,12 @@ import pandas as pd
 import os
 from function.read_data_config import ReadConfig
 from function.read_index_columns import ReadIndex
+from factor_utils import CHUNK_SIZE, merge_duplicates, read_index, read_sql_stream, write_factor, write_factors
+
+try:
+    import connectorx as cx  # optional, reads query results straight into numpy arrays with parallel connections
+except ImportError:
+    cx = None
 
 
 class EodDerivativeIndicator:
@@ -53,13 +59,22 @@ class EodDerivativeIndicator:
 
     """
 
-    def __init__(self):
-        """Initialize the class"""
+    def __init__(self, index: list = None, column: list = None):
+        """
+        Initialize the class
+        :param index: list, the date list constructed before, read by ReadIndex if not given
+        :param column: list, the stock list constructed before, read by ReadIndex if not given
+        Note:
+            pass index and column read once when running several classes together, so they are not read again
+        """
 
         # initialize parameters we gonna use later
-        ri = ReadIndex()
-        self.index = ri.read_index()     # For the date list we constructed before
-        self.column = ri.read_columns()  # For the stock list we constructed before
+        if index is None or column is None:
+            ri = ReadIndex()
+            index = ri.read_index() if index is None else index
+            column = ri.read_columns() if column is None else column
+        self.index = index    # For the date list we constructed before
+        self.column = column  # For the stock list we constructed before
 
         rc = ReadConfig()
         self.db = rc.read_wind_mysql()
@@ -80,6 +95,9 @@ class EodDerivativeIndicator:
                               'LOWEST_HIGHEST_STATUS']
 
         self.factor_name_str = ', '.join(self.target_column)  # transfer factor names to str for sql
+        # path of the local file of each factor, self.data_path is already absolute
+        self.factor_path = {factor: os.path.join(self.data_path, '{}.hdf5'.format(factor))
+                            for factor in self.target_column}
 
     def read_data(self, begin_date: str = '20160101') -> pd.DataFrame:
         """
@@ -91,22 +109,69 @@ class EodDerivativeIndicator:
         begin = datetime.now()
         print("Reading data from server, this process normally takes around 9 minutes... ")
 
-        chunk_size = 1000000
-        offset = 0
-        dfs = []
-        while True:
+        dfs = None
+        if cx is not None and hasattr(self.db, 'url'):
+            # split the query by year, connectorx runs them on parallel connections and builds one DataFrame
+            # connectorx does not take query parameters, the dates are quoted so they are compared as strings
             sql = """
             SELECT S_INFO_WINDCODE, TRADE_DT, {}
             FROM wind.ASHAREEODDERIVATIVEINDICATOR
-            WHERE TRADE_DT >= {}
-            LIMIT {}
-            OFFSET {};
-            """.format(self.factor_name_str, begin_date, chunk_size, offset)
-            dfs.append(pd.read_sql(sql, self.db))
-            offset += chunk_size
-            if len(dfs[-1]) < chunk_size:
-                break
+            WHERE TRADE_DT >= '{}' AND TRADE_DT < '{}';
+            """
+            queries = [sql.format(self.factor_name_str, max(begin_date, '{}0101'.format(year)), '{}0101'.format(year+1))
+                       for year in range(int(begin_date[:4]), datetime.now().year + 1)]
+            try:
+                # URL.set and render_as_string need SQLAlchemy 1.4+, and connectorx may not accept every option of
+                # the engine url, so any failure here falls back to reading with pandas below
+                uri = self.db.url.set(drivername='mysql').render_as_string(hide_password=False)
+                dfs = [cx.read_sql(uri, queries, return_type='pandas')]
+            except Exception as e:
+                print("Failed to read data with connectorx, fall back to pandas:", repr(e))
+
+        if dfs is None and hasattr(self.db, 'execution_options'):
+            # stream the result set with a server-side cursor, so the driver does not buffer every row at once
+            sql = """
+            SELECT S_INFO_WINDCODE, TRADE_DT, {}
+            FROM wind.ASHAREEODDERIVATIVEINDICATOR
+            WHERE TRADE_DT >= %s;
+            """.format(self.factor_name_str)
+            dfs = [read_sql_stream(sql, self.db, params=(begin_date,))]
+
+        elif dfs is None:
+            # the driver would buffer the whole result set, so we page through the table instead. Each page starts
+            # from the last TRADE_DT we have seen, rather than using LIMIT/OFFSET which makes MySQL scan and discard
+            # every row before the offset for each page
+            # (TRADE_DT, S_INFO_WINDCODE) is not unique, so a page cannot start in the middle of a date: the last date
+            # of a full page may be cut off by LIMIT, so its rows are dropped from the page and the date is read on its
+            # own, then the next page starts after it. Every page moves forward by at least one date
+            page_sql = """
+            SELECT S_INFO_WINDCODE, TRADE_DT, {}
+            FROM wind.ASHAREEODDERIVATIVEINDICATOR
+            WHERE TRADE_DT > %s
+            ORDER BY TRADE_DT, S_INFO_WINDCODE
+            LIMIT %s;
+            """.format(self.factor_name_str)
+            date_sql = """
+            SELECT S_INFO_WINDCODE, TRADE_DT, {}
+            FROM wind.ASHAREEODDERIVATIVEINDICATOR
+            WHERE TRADE_DT = %s
+            ORDER BY S_INFO_WINDCODE;
+            """.format(self.factor_name_str)
+            last_date = begin_date
+            dfs = [pd.read_sql(date_sql, self.db, params=(begin_date,))]
+            while True:
+                page = pd.read_sql(page_sql, self.db, params=(last_date, CHUNK_SIZE))
+                if len(page) < CHUNK_SIZE:
+                    dfs.append(page)
+                    break
+                last_date = page.TRADE_DT.iloc[-1]
+                dfs.append(page[page.TRADE_DT < last_date])
+                dfs.append(pd.read_sql(date_sql, self.db, params=(last_date,)))
+
         data = pd.concat(dfs)
+        # stock codes and dates repeat in millions of rows, categorical dtype stores each of them only once
+        data['S_INFO_WINDCODE'] = data['S_INFO_WINDCODE'].astype('category')
+        data['TRADE_DT'] = data['TRADE_DT'].astype('category')
         end = datetime.now()
         print("Finished reading data from server, spend:", end - begin)
         return data
@@ -118,19 +183,30 @@ class EodDerivativeIndicator:
         :return: object, corresponding factor data stored in local
         """
 
-        return pd.read_hdf(os.path.abspath(os.path.join(self.data_path, '{}.hdf5'.format(factor))), key=factor)
+        return pd.read_hdf(self.factor_path[factor], key=factor)
+
+    def read_exist_index(self, factor: str) -> list:
+        """
+        Read only the dates of exist wind.ASHAREEODDERIVATIVEINDICATOR data of a factor from local
+        :param factor: str
+        :return: list, dates stored in local
+        """
+
+        return read_index(self.factor_path[factor], factor)
 
     def rewrite_data(self):
         """Split data into 33 tables by factors"""
 
         eod_derivative_indicator = self.read_data()  # this will pull data after 20160101 as default
         begin = datetime.now()
-        unstack_data = eod_derivative_indicator.groupby(['TRADE_DT', 'S_INFO_WINDCODE']).max().unstack()
+        eod_derivative_indicator = merge_duplicates(eod_derivative_indicator, ['TRADE_DT', 'S_INFO_WINDCODE'])
 
-        # output to hdf5 file for corresponding factor in self.target_column
-        for factor in tqdm(self.target_column):
-            factor_table = unstack_data[factor].reindex(columns=self.column)
-            factor_table.to_hdf(os.path.abspath(os.path.join(self.data_path, '{}.hdf5'.format(factor))), key=factor)
+        # output to hdf5 file for corresponding factor in self.target_column, files are written in parallel
+        # factors are unstacked one at a time as workers become free, instead of unstacking the whole data into one
+        # huge table
+        jobs = ((eod_derivative_indicator[factor].unstack().reindex(columns=self.column), self.factor_path[factor],
+                 factor) for factor in self.target_column)
+        write_factors(jobs, len(self.target_column))
 
         end = datetime.now()
         print("Finished rewriting data, spend:", end - begin)
@@ -141,10 +217,12 @@ class EodDerivativeIndicator:
         Note:
             1. if there is no new data to update, we end the function directly
             2. we start reading from the first date of new data, so we do not pull superfluous data from database
+            3. only the index of one table is read to find new dates; the other tables still have to be read in full,
+               since fixed format tables cannot be appended in place (see factor_utils.read_index)
         """
 
-        s_val_mv = self.read_exist_data('S_VAL_MV')  # pick one to compare if update is needed
-        new_date = sorted(list(set(self.index) - set(s_val_mv.index)))
+        s_val_mv = self.read_exist_index('S_VAL_MV')  # pick one to compare if update is needed
+        new_date = pd.Index(self.index).difference(s_val_mv).sort_values().tolist()
 
         if len(new_date) == 0:  # new_date == [] means there is no new data to update, so we end the function
             print("Data is already updated!")
@@ -152,13 +230,14 @@ class EodDerivativeIndicator:
 
         eod_derivative_indicator = self.read_data(new_date[0])  # start reading from the first date in new_date
         begin = datetime.now()
-        unstack_data = eod_derivative_indicator.groupby(['TRADE_DT', 'S_INFO_WINDCODE']).max().unstack()
+        eod_derivative_indicator = merge_duplicates(eod_derivative_indicator, ['TRADE_DT', 'S_INFO_WINDCODE'])
 
         # append update data to old data (from local) for each factor
         for factor in tqdm(self.target_column):
             exist_data = self.read_exist_data(factor)
-            factor_table = exist_data.append(unstack_data[factor]).reindex(columns=self.column)
-            factor_table.to_hdf(os.path.abspath(os.path.join(self.data_path, '{}.hdf5'.format(factor))), key=factor)
+            factor_table = pd.concat([exist_data, eod_derivative_indicator[factor].unstack()], copy=False)
+            factor_table = factor_table.reindex(columns=self.column)
+            write_factor(factor_table, self.factor_path[factor], factor)
 
         end = datetime.now()
         print("Finished updating data, spend:", end - begin)
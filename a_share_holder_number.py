@@ -2,20 +2,31 @@ __author__ = 'Lingsong Zeng'
 
 from datetime import datetime
 import pandas as pd
+import numpy as np
 import os
 from function.read_data_config import ReadConfig
 from function.read_index_columns import ReadIndex
+from factor_utils import write_factor
 
 
 class HolderNumber:
 
-    def __init__(self):
-        """Initialize the class"""
+    def __init__(self, index: list = None, column: list = None):
+        """
+        Initialize the class
+        :param index: list, the date list constructed before, read by ReadIndex if not given
+        :param column: list, the stock list constructed before, read by ReadIndex if not given
+        Note:
+            pass index and column read once when running several classes together, so they are not read again
+        """
 
         # initialize parameters we gonna use later
-        ri = ReadIndex()
-        self.index = ri.read_index()  # For the date list we constructed before
-        self.column = ri.read_columns()  # For the stock list we constructed before
+        if index is None or column is None:
+            ri = ReadIndex()
+            index = ri.read_index() if index is None else index
+            column = ri.read_columns() if column is None else column
+        self.index = index    # For the date list we constructed before
+        self.column = column  # For the stock list we constructed before
 
         rc = ReadConfig()
         self.db = rc.read_wind_mysql()
@@ -24,6 +35,7 @@ class HolderNumber:
         self.data_path = os.path.abspath(os.path.join(data_path, 'ASHAREHOLDERNUMBER'))
         if not os.path.exists(self.data_path):
             os.makedirs(self.data_path)
+        self.file_path = os.path.join(self.data_path, 'holder_number.hdf5')  # self.data_path is already absolute
 
     def read_data_before_begin_date(self, begin_date: str) -> pd.DataFrame:
         """
@@ -37,13 +49,14 @@ class HolderNumber:
             FROM (
                 SELECT S_INFO_WINDCODE, max(ANN_DT) as LAST_ANN_DT
                 FROM wind.ASHAREHOLDERNUMBER
-                WHERE ANN_DT < {} AND S_INFO_WINDCODE NOT REGEXP '^[a-zA-Z]'
+                WHERE ANN_DT < %s AND S_INFO_WINDCODE NOT REGEXP '^[a-zA-Z]'
                 GROUP BY S_INFO_WINDCODE
             ) AS x INNER JOIN wind.ASHAREHOLDERNUMBER AS f ON f.S_INFO_WINDCODE = x.S_INFO_WINDCODE
             AND f.ANN_DT = x.LAST_ANN_DT
-            """.format(begin_date)
+            ORDER BY f.S_INFO_WINDCODE, f.ANN_DT, f.S_HOLDER_ENDDATE;
+            """
 
-        return pd.read_sql(sql, self.db)
+        return pd.read_sql(sql, self.db, params=(begin_date,))
 
     def read_data_after_begin_date(self, begin_date: str) -> pd.DataFrame:
         """
@@ -55,10 +68,11 @@ class HolderNumber:
         sql = """
             SELECT S_INFO_WINDCODE, ANN_DT, S_HOLDER_ENDDATE, S_HOLDER_NUM
             FROM wind.ASHAREHOLDERNUMBER
-            WHERE ANN_DT >= {} AND S_INFO_WINDCODE NOT REGEXP '^[a-zA-Z]';
-            """.format(begin_date)
+            WHERE ANN_DT >= %s AND S_INFO_WINDCODE NOT REGEXP '^[a-zA-Z]'
+            ORDER BY S_INFO_WINDCODE, ANN_DT, S_HOLDER_ENDDATE;
+            """
 
-        return pd.read_sql(sql, self.db)
+        return pd.read_sql(sql, self.db, params=(begin_date,))
 
     def read_data(self, begin_date: str = '20160101') -> pd.DataFrame:
         """
@@ -72,9 +86,12 @@ class HolderNumber:
         data_a = self.read_data_before_begin_date(begin_date)
         data_b = self.read_data_after_begin_date(begin_date)
 
+        data = pd.concat([data_a, data_b], ignore_index=True, copy=False)
+        data['S_INFO_WINDCODE'] = data['S_INFO_WINDCODE'].astype('category')  # store each stock code only once
+
         end = datetime.now()
         print("Finished reading data from server, spend:", end - begin)
-        return data_a.append(data_b, ignore_index=True)
+        return data
 
     def read_exist_data(self) -> object:
         """
@@ -82,41 +99,38 @@ class HolderNumber:
         :return: object
         """
 
-        data_path = os.path.abspath(os.path.join(self.data_path, 'holder_number.hdf5'))
-        return pd.read_hdf(data_path, key='holder_number')
+        return pd.read_hdf(self.file_path, key='holder_number')
+
+    def build_table(self, data: pd.DataFrame, index: list) -> pd.DataFrame:
+        """
+        Build the holder number table, an announced number is filled forward until the next announcement
+        :param data: pd.DataFrame, data from read_data
+        :param index: list, dates of the table
+        :return: pd.DataFrame, index -> index, columns -> self.column
+        """
+
+        # keep the last record (with the latest S_HOLDER_ENDDATE) if one stock announces more than once on a date
+        # records are sorted by the database, and the two parts from read_data never share an ANN_DT
+        data = data.drop_duplicates(['S_INFO_WINDCODE', 'ANN_DT'], keep='last').dropna(subset=['S_HOLDER_NUM'])
+
+        # an announcement takes effect from the first date on or after its ANN_DT
+        date_pos = pd.Index(index).searchsorted(data.ANN_DT.values)
+        code_pos = pd.Index(self.column).get_indexer(data.S_INFO_WINDCODE)
+        found = (date_pos < len(index)) & (code_pos >= 0)  # drop announcements out of the table
+
+        # records of a stock are in order of ANN_DT, so the largest record number up to a date is the latest
+        # announcement of that stock, got by a cumulative max along dates (-1 if there is no announcement yet)
+        latest = np.full((len(index), len(self.column)), -1)
+        np.maximum.at(latest, (date_pos[found], code_pos[found]), np.arange(len(data))[found])
+        latest = np.maximum.accumulate(latest, axis=0)
+        value = np.where(latest >= 0, data.S_HOLDER_NUM.values[latest], np.nan)
+
+        return pd.DataFrame(value, index=index, columns=self.column)
 
     def rewrite_data(self):
         a_share_holder_number = self.read_data()  # begin_date will set to '20160101' as default
-        a_share_holder_number.sort_values(['S_INFO_WINDCODE', 'ANN_DT', 'S_HOLDER_ENDDATE'], inplace=True)
-
-        data_iter = a_share_holder_number.itertuples()
-        pre_record = next(data_iter)
-        holder_number = {}
-        stock_dict = {}
-
-        for record in data_iter:
-            _, code_1, ann_dt_1, end_dt_1, holder_num_1 = pre_record
-            _, code_2, ann_dt_2, end_dt_2, holder_num_2 = record
-
-            if code_1 != code_2:
-                stock_dict[ann_dt_1] = holder_num_1
-                holder_number[code_1] = stock_dict.copy()
-                stock_dict.clear()
-            else:
-                if ann_dt_1 == ann_dt_2:
-                    pass
-                else:
-                    stock_dict[ann_dt_1] = holder_num_1
-            pre_record = record
-
-        _, code_1, ann_dt_1, end_dt_1, holder_num_1 = pre_record
-        stock_dict[ann_dt_1] = holder_num_1
-        holder_number[code_1] = stock_dict.copy()
-
-        index_range = sorted(list(set(self.index) | set(a_share_holder_number.ANN_DT)))
-        df = pd.DataFrame(holder_number, index=index_range).fillna(method='ffill')
-        df = df.reindex(index=self.index, columns=self.column)
-        df.to_hdf(os.path.abspath(os.path.join(self.data_path, 'holder_number.hdf5')), key='holder_number')
+        df = self.build_table(a_share_holder_number, self.index)
+        write_factor(df, self.file_path, 'holder_number')
 
     def update_data(self):
         """
@@ -128,7 +142,7 @@ class HolderNumber:
 
         # exist_data from local
         holder_number_local = self.read_exist_data()
-        new_date = sorted(list(set(self.index) - set(holder_number_local.index)))
+        new_date = pd.Index(self.index).difference(holder_number_local.index).sort_values().tolist()
 
         # len(new_date) == 0 means no need to update so we end the function
         if len(new_date) == 0:
@@ -136,36 +150,9 @@ class HolderNumber:
             return None  # function ends here
 
         a_share_holder_number = self.read_data(new_date[0])
-        a_share_holder_number.sort_values(['S_INFO_WINDCODE', 'ANN_DT', 'S_HOLDER_ENDDATE'], inplace=True)
-
-        data_iter = a_share_holder_number.itertuples()
-        pre_record = next(data_iter)
-        holder_number = {}
-        stock_dict = {}
-
-        for record in data_iter:
-            _, code_1, ann_dt_1, end_dt_1, holder_num_1 = pre_record
-            _, code_2, ann_dt_2, end_dt_2, holder_num_2 = record
-
-            if code_1 != code_2:
-                stock_dict[ann_dt_1] = holder_num_1
-                holder_number[code_1] = stock_dict.copy()
-                stock_dict.clear()
-            else:
-                if ann_dt_1 == ann_dt_2:
-                    pass
-                else:
-                    stock_dict[ann_dt_1] = holder_num_1
-            pre_record = record
-
-        _, code_1, ann_dt_1, end_dt_1, holder_num_1 = pre_record
-        stock_dict[ann_dt_1] = holder_num_1
-        holder_number[code_1] = stock_dict.copy()
-
-        index_range = sorted(list(set(self.index) | set(a_share_holder_number.ANN_DT)))
-        df = pd.DataFrame(holder_number, index=index_range).fillna(method='ffill')
-        df = holder_number_local.append(df).reindex(index=self.index, columns=self.column)
-        df.to_hdf(os.path.abspath(os.path.join(self.data_path, 'holder_number.hdf5')), key='holder_number')
+        df = self.build_table(a_share_holder_number, new_date)  # only new dates are appended to local data
+        df = pd.concat([holder_number_local, df], copy=False).reindex(index=self.index, columns=self.column)
+        write_factor(df, self.file_path, 'holder_number')
 
 
 if __name__ == '__main__':
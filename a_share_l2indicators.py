@@ -6,6 +6,7 @@ import pandas as pd
 import os
 from function.read_data_config import ReadConfig
 from function.read_index_columns import ReadIndex
+from factor_utils import merge_duplicates, read_index, read_sql_stream, write_factor, write_factors
 
 
 class L2Indicators:
@@ -45,12 +46,26 @@ class L2Indicators:
                 ...   |     ...   |    ...    | ... |    ...    |     ...
     """
 
-    def __init__(self):
-        """Initialize the class"""
+    def __init__(self, index: list = None, column: list = None, file_format: str = 'hdf5'):
+        """
+        Initialize the class
+        :param index: list, the date list constructed before, read by ReadIndex if not given
+        :param column: list, the stock list constructed before, read by ReadIndex if not given
+        :param file_format: str, 'hdf5' (default) or 'feather' (needs pyarrow), format of local factor files
+        Note:
+            pass index and column read once when running several classes together, so they are not read again
+        """
 
-        ri = ReadIndex()
-        self.index = ri.read_index()     # For the date list we constructed before
-        self.column = ri.read_columns()  # For the stock list we constructed before
+        if file_format not in ('hdf5', 'feather'):
+            raise ValueError("file_format should be 'hdf5' or 'feather', got {!r}".format(file_format))
+
+        if index is None or column is None:
+            ri = ReadIndex()
+            index = ri.read_index() if index is None else index
+            column = ri.read_columns() if column is None else column
+        self.index = index    # For the date list we constructed before
+        self.column = column  # For the stock list we constructed before
+        self.file_format = file_format
 
         rc = ReadConfig()
         self.db = rc.read_wind_mysql()
@@ -68,6 +83,10 @@ class L2Indicators:
                               'S_LI_ENTRUSTSELLMONEY', 'S_LI_ENTRUSTBUYAMOUNT', 'S_LI_ENTRUSTSELLAMOUNT']
 
         self.factor_name_str = ', '.join(self.target_column)  # transfer factor names to str for sql
+        # path of the local file of each factor, self.data_path is already absolute
+        self.factor_path = {factor: os.path.join(self.data_path, '{}.{}'.format(factor, self.file_format))
+                            for factor in self.target_column}
+        self.code_str = ', '.join("'{}'".format(code) for code in self.column)  # only read stocks in self.column
 
     def read_data(self, begin_date: str = '20160101') -> pd.DataFrame:
         """
@@ -82,10 +101,11 @@ class L2Indicators:
         sql = """
         SELECT S_INFO_WINDCODE, TRADE_DT, {}
         FROM wind.ASHAREL2INDICATORS
-        WHERE TRADE_DT >= {};
-        """.format(self.factor_name_str, begin_date)
+        WHERE TRADE_DT >= %s AND S_INFO_WINDCODE IN ({});
+        """.format(self.factor_name_str, self.code_str)
 
-        data = pd.read_sql(sql, self.db)
+        data = read_sql_stream(sql, self.db, params=(begin_date,))
+        data['S_INFO_WINDCODE'] = data['S_INFO_WINDCODE'].astype('category')  # store each stock code only once
         end = datetime.now()
         print("Finished reading data from server, spend:", end - begin)
         return data
@@ -97,19 +117,33 @@ class L2Indicators:
         :return: object, corresponding factor data stored in local
         """
 
-        return pd.read_hdf(os.path.abspath(os.path.join(self.data_path, '{}.hdf5'.format(factor))), key=factor)
+        data_path = self.factor_path[factor]
+        if self.file_format == 'feather':
+            return pd.read_feather(data_path).set_index('TRADE_DT')
+        return pd.read_hdf(data_path, key=factor)
+
+    def read_exist_index(self, factor: str) -> list:
+        """
+        Read only the dates of exist wind.ASHAREL2INDICATORS data of a factor from local, without loading its values
+        :param factor: str
+        :return: list, dates stored in local
+        """
+
+        return read_index(self.factor_path[factor], factor, self.file_format)
 
     def rewrite_data(self):
         """Split data into 12 tables by factors"""
 
         a_share_l2indicators = self.read_data()  # this will pull data after 20160101 as default
         begin = datetime.now()
-        unstack_data = a_share_l2indicators.groupby(['TRADE_DT', 'S_INFO_WINDCODE']).max().unstack()
+        a_share_l2indicators = merge_duplicates(a_share_l2indicators, ['TRADE_DT', 'S_INFO_WINDCODE'])
 
-        # output to hdf5 file for corresponding factor in self.target_column
-        for factor in tqdm(self.target_column):
-            factor_table = unstack_data[factor].reindex(columns=self.column)
-            factor_table.to_hdf(os.path.abspath(os.path.join(self.data_path, factor + '.hdf5')), key=factor)
+        # output to file for corresponding factor in self.target_column, files are written in parallel
+        # factors are unstacked one at a time as workers become free, instead of unstacking the whole data into one
+        # huge table
+        jobs = ((a_share_l2indicators[factor].unstack().reindex(columns=self.column), self.factor_path[factor], factor,
+                 self.file_format) for factor in self.target_column)
+        write_factors(jobs, len(self.target_column))
 
         end = datetime.now()
         print("Finished rewriting data, spend:", end - begin)
@@ -120,24 +154,26 @@ class L2Indicators:
         Note:
             1. if there is no new data to update, we end the function directly
             2. we start reading from the first date of new data, so we do not pull superfluous data from database
+            3. each factor table is read only once, in the loop below; checking for new dates needs the index only
         """
 
-        entrustrate = self.read_exist_data('S_LI_ENTRUSTRATE')  # pick one to compare if update is needed
-        new_date = sorted(list(set(self.index) - set(entrustrate.index)))
+        entrustrate = self.read_exist_index('S_LI_ENTRUSTRATE')  # pick one to compare if update is needed
+        new_date = pd.Index(self.index).difference(entrustrate).sort_values().tolist()
 
         if len(new_date) == 0:  # new_date == [] means there is no new data to update, so we end the function
             print("Data is already updated!")
             return None  # function ends here
 
-        a_share_income = self.read_data(new_date[0])  # start reading from the first date in new_date
+        a_share_l2indicators = self.read_data(new_date[0])  # start reading from the first date in new_date
         begin = datetime.now()
-        unstack_data = a_share_income.groupby(['TRADE_DT', 'S_INFO_WINDCODE']).max().unstack()
+        a_share_l2indicators = merge_duplicates(a_share_l2indicators, ['TRADE_DT', 'S_INFO_WINDCODE'])
 
         # append update data to old data (from local) for each factor
         for factor in tqdm(self.target_column):
             exist_data = self.read_exist_data(factor)
-            factor_table = exist_data.append(unstack_data[factor]).reindex(columns=self.column)
-            factor_table.to_hdf(os.path.abspath(os.path.join(self.data_path, factor + '.hdf5')), key=factor)
+            factor_table = pd.concat([exist_data, a_share_l2indicators[factor].unstack()], copy=False)
+            factor_table = factor_table.reindex(columns=self.column)
+            write_factor(factor_table, self.factor_path[factor], factor, self.file_format)
 
         end = datetime.now()
         print("Finished updating data, spend:", end - begin)
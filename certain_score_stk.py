@@ -3,9 +3,11 @@ __author__ = 'Lingsong Zeng'
 from datetime import datetime
 from tqdm import tqdm
 import pandas as pd
+import numpy as np
 import os
 from function.read_data_config import ReadConfig
 from function.read_index_columns import ReadIndex
+from factor_utils import merge_duplicates, read_index, read_sql_stream, write_factor, write_factors
 
 
 class CertainScoreStk:
@@ -35,12 +37,26 @@ class CertainScoreStk:
                  ...   |    ...    |    ...    |    ...    |
     """
 
-    def __init__(self):
-        """Initialize the class"""
+    def __init__(self, index: list = None, column: list = None, file_format: str = 'hdf5'):
+        """
+        Initialize the class
+        :param index: list, the date list constructed before, read by ReadIndex if not given
+        :param column: list, the stock list constructed before, read by ReadIndex if not given
+        :param file_format: str, 'hdf5' (default) or 'feather' (needs pyarrow), format of local factor files
+        Note:
+            pass index and column read once when running several classes together, so they are not read again
+        """
+
+        if file_format not in ('hdf5', 'feather'):
+            raise ValueError("file_format should be 'hdf5' or 'feather', got {!r}".format(file_format))
 
-        ri = ReadIndex()
-        self.index = ri.read_index()     # For the date list we constructed before
-        self.column = ri.read_columns()  # For the stock list we constructed before
+        if index is None or column is None:
+            ri = ReadIndex()
+            index = ri.read_index() if index is None else index
+            column = ri.read_columns() if column is None else column
+        self.index = index    # For the date list we constructed before
+        self.column = column  # For the stock list we constructed before
+        self.file_format = file_format
 
         rc = ReadConfig()
         self.db = rc.read_suntime_mysql()
@@ -52,6 +68,12 @@ class CertainScoreStk:
 
         self.target_column = ['score', 'profit_score', 'value_score', 'market_score', 'score_grate_1w',
                               'score_grate_4w', 'score_grate_13w', 'score_grate_26w', 'score_grate_52w']
+        # path of the local file of each factor, self.data_path is already absolute
+        self.factor_path = {factor: os.path.join(self.data_path, '{}.{}'.format(factor, self.file_format))
+                            for factor in self.target_column}
+
+        # only read stocks in self.column, the database stores stock codes without the '.SH'/'.SZ' suffix
+        self.code_str = ', '.join("'{}'".format(code.split('.')[0]) for code in self.column)
 
     def read_data(self, begin_date: str = '20160101') -> pd.DataFrame:
         """
@@ -74,14 +96,19 @@ class CertainScoreStk:
         print("Reading data from server... ")
 
         sql = """
-        SELECT DATE_FORMAT(con_date, '%Y%m%d') AS con_date,
-               IF(stock_code REGEXP '^6', CONCAT(stock_code, '.SH'), CONCAT(stock_code, '.SZ')) AS stock_code,
-               {}, {}, {}, {}, {}, {}, {}, {}, {}
+        SELECT DATE_FORMAT(con_date, '%%Y%%m%%d') AS con_date, stock_code, {}, {}, {}, {}, {}, {}, {}, {}, {}
         FROM suntime.certainty_score_stk
-        WHERE index_code = 999999 AND con_date >= {};
-        """.format(*self.target_column, begin_date)
+        WHERE index_code = 999999 AND con_date >= %s AND stock_code IN ({});
+        """.format(*self.target_column, self.code_str)
+
+        data = read_sql_stream(sql, self.db, params=(begin_date,))
+        data['stock_code'] = data['stock_code'].astype('category')  # store each stock code only once
+
+        # add '.SH' to codes starting with 6 and '.SZ' to the others, once per stock code instead of once per row
+        codes = data['stock_code'].cat.categories
+        data['stock_code'] = data['stock_code'].cat.rename_categories(
+            np.where(codes.str.startswith('6'), codes + '.SH', codes + '.SZ'))
 
-        data = pd.read_sql(sql, self.db)
         end = datetime.now()
         print("Finished reading data from server, spend:", end - begin)
         return data
@@ -93,7 +120,19 @@ class CertainScoreStk:
         :return: object, corresponding factor data stored in local
         """
 
-        return pd.read_hdf(os.path.abspath(os.path.join(self.data_path, '{}.hdf5'.format(factor))), key=factor)
+        data_path = self.factor_path[factor]
+        if self.file_format == 'feather':
+            return pd.read_feather(data_path).set_index('con_date')
+        return pd.read_hdf(data_path, key=factor)
+
+    def read_exist_index(self, factor: str) -> list:
+        """
+        Read only the dates of exist certainty_score_stk data of a factor from local, without loading its values
+        :param factor: str
+        :return: list, dates stored in local
+        """
+
+        return read_index(self.factor_path[factor], factor, self.file_format, 'con_date')
 
     def rewrite_data(self):
         """Split data into 9 tables by factors"""
@@ -101,26 +140,25 @@ class CertainScoreStk:
         certainty_score_stk = self.read_data()  # this will pull data after 20160101 as default
 
         begin = datetime.now()
-        unstack_data = certainty_score_stk.groupby(['con_date', 'stock_code']).max().unstack()
+        certainty_score_stk = merge_duplicates(certainty_score_stk, ['con_date', 'stock_code'])
 
         # ==============================================================================================================
-        # unstack_data:
-        #                       score                      ... score_grate_52w                      -> column 1
-        #    ->  stock_code 000001.SZ 000002.SZ 000004.SZ  ...       688788.SH 688981.SH 689009.SH  -> column 2
-        #    ->  con_date                                  ...
-        #        20160104       56.35     75.95     52.55  ...             NaN       NaN       NaN  -> np.NaN
-        #        20160105       56.35     75.95     52.55  ...             NaN       NaN       NaN
-        #        20160106       56.35     75.95     52.55  ...             NaN       NaN       NaN
-        #        ...              ...       ...       ...  ...             ...       ...       ...
-        #        20201120       64.15     73.90     48.45  ...             NaN       NaN       NaN
-        #        20201123       64.15     78.90     48.45  ...             NaN       NaN       NaN
-        #        20201124       64.15     83.90     48.45  ...             NaN       NaN       NaN
+        # certainty_score_stk:
+        #                                score  ...  score_grate_52w
+        #    ->  con_date stock_code                ...
+        #        20160104 000001.SZ      56.35  ...              ...
+        #                 000002.SZ      75.95  ...              ...
+        #        ...      ...              ...  ...              ...
+        #        20201124 689009.SH        ...  ...              NaN  -> np.NaN
+        #
+        # each factor is unstacked on its own into (con_date x stock_code) as workers become free, instead of
+        # unstacking every factor into one huge table first
         # ==============================================================================================================
 
-        # output to hdf5 file for corresponding factor in self.target_column
-        for factor in tqdm(self.target_column):
-            factor_table = unstack_data[factor].reindex(columns=self.column)
-            factor_table.to_hdf(os.path.abspath(os.path.join(self.data_path, factor + '.hdf5')), key=factor)
+        # output to file for corresponding factor in self.target_column, files are written in parallel
+        jobs = ((certainty_score_stk[factor].unstack().reindex(columns=self.column), self.factor_path[factor], factor,
+                 self.file_format, 'con_date') for factor in self.target_column)
+        write_factors(jobs, len(self.target_column))
 
         end = datetime.now()
         print("Finished rewriting data, spend:", end - begin)
@@ -131,10 +169,11 @@ class CertainScoreStk:
         Note:
             1. if there is no new data to update, we end the function directly
             2. we start reading from the first date of new data, so we do not pull superfluous data from database
+            3. each factor table is read only once, in the loop below; checking for new dates needs the index only
         """
 
-        score = self.read_exist_data('score')  # pick one of table from local to compare if update is needed
-        new_date = sorted(list(set(self.index) - set(score.index)))
+        score = self.read_exist_index('score')  # pick one of table from local to compare if update is needed
+        new_date = pd.Index(self.index).difference(score).sort_values().tolist()
 
         if len(new_date) == 0:  # new_date == [] means there is no new data to update, so we end the function
             print("Data is already updated!")
@@ -143,13 +182,14 @@ class CertainScoreStk:
         certainty_score_stk = self.read_data(new_date[0])  # start reading from the first date in new_date
 
         begin = datetime.now()
-        unstack_data = certainty_score_stk.groupby(['con_date', 'stock_code']).max().unstack()
+        certainty_score_stk = merge_duplicates(certainty_score_stk, ['con_date', 'stock_code'])
 
         # append update data to old data (from local) for each factor
         for factor in tqdm(self.target_column):
             exist_data = self.read_exist_data(factor)
-            factor_table = exist_data.append(unstack_data[factor]).reindex(columns=self.column)
-            factor_table.to_hdf(os.path.abspath(os.path.join(self.data_path, factor + '.hdf5')), key=factor)
+            factor_table = pd.concat([exist_data, certainty_score_stk[factor].unstack()], copy=False)
+            factor_table = factor_table.reindex(columns=self.column)
+            write_factor(factor_table, self.factor_path[factor], factor, self.file_format, 'con_date')
 
         end = datetime.now()
         print("Finished updating data, spend:", end - begin)
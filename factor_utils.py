@@ -0,0 +1,115 @@
+__author__ = 'Lingsong Zeng'
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from tqdm import tqdm
+import pandas as pd
+import os
+
+CHUNK_SIZE = 500000  # rows fetched from the database at a time
+
+
+def read_sql_stream(sql: str, db, params: tuple = None) -> pd.DataFrame:
+    """
+    Read the result of sql in chunks of CHUNK_SIZE rows
+    Note:
+        the result set is streamed with a server-side cursor (if supported) to avoid buffering all rows in the driver
+    :param sql: str
+    :param db: sqlalchemy engine or connection to the database
+    :param params: tuple, parameters of the query
+    :return: pd.DataFrame
+    """
+
+    db = db.execution_options(stream_results=True) if hasattr(db, 'execution_options') else db
+    return pd.concat(list(pd.read_sql(sql, db, params=params, chunksize=CHUNK_SIZE)), ignore_index=True)
+
+
+def write_factor(factor_table: pd.DataFrame, data_path: str, key: str, file_format: str = 'hdf5',
+                 index_label: str = 'TRADE_DT'):
+    """
+    Write one factor table to local, defined at module level so it can be sent to worker processes
+    Note:
+        every factor table is kept in its own file rather than as a key of one shared file, so that tables can be
+        written by several processes at the same time, and other projects can keep reading them by file name
+    :param factor_table: pd.DataFrame
+    :param data_path: str, path of the hdf5 or feather file
+    :param key: str, key of the table in the hdf5 file
+    :param file_format: str, 'hdf5' (default) or 'feather'
+    :param index_label: str, name of the date column in the feather file (default 'TRADE_DT')
+    """
+
+    if file_format == 'feather':
+        # feather files have no index, so dates are stored as the first column
+        factor_table.rename_axis(index_label).reset_index().to_feather(data_path)
+    else:
+        factor_table.to_hdf(data_path, key=key, complib='blosc:lz4', complevel=5)
+
+
+def read_index(data_path: str, key: str, file_format: str = 'hdf5', index_label: str = 'TRADE_DT') -> list:
+    """
+    Read only the dates of a factor table written by write_factor, without loading its values
+    Note:
+        hdf5 tables are stored in fixed format (table format cannot hold thousands of stock columns), so we read the
+        index node directly instead of loading the whole table
+    :param data_path: str, path of the hdf5 or feather file
+    :param key: str, key of the table in the hdf5 file
+    :param file_format: str, 'hdf5' (default) or 'feather'
+    :param index_label: str, name of the date column in the feather file (default 'TRADE_DT')
+    :return: list, dates stored in local
+    """
+
+    if file_format == 'feather':
+        return pd.read_feather(data_path, columns=[index_label])[index_label].tolist()
+    with pd.HDFStore(data_path, mode='r') as store:
+        return store.get_storer(key).read_index('axis1').tolist()
+
+
+def merge_duplicates(data: pd.DataFrame, keys: list) -> pd.DataFrame:
+    """
+    Index data by keys (date, stock code), a stock with several records on one date keeps the max of each factor
+    Note:
+        such records are rare, so only the duplicated records are grouped, the rest are indexed as they are
+    :param data: pd.DataFrame, data from read_data
+    :param keys: list, names of the date and stock code columns
+    :return: pd.DataFrame, indexed by keys, columns are the factors
+    """
+
+    duplicated = data.duplicated(keys, keep=False)
+    data = pd.concat([data[~duplicated].set_index(keys), data[duplicated].groupby(keys, observed=True).max()])
+
+    # categorical index cannot be stored in hdf5 file, so we turn the levels back to str
+    data.index = data.index.set_levels([level.astype(str) for level in data.index.levels])
+    return data
+
+
+def write_factors(jobs, total: int, max_workers: int = None):
+    """
+    Write factor tables to local by worker processes in parallel
+    Note:
+        the executor holds every submitted table until it is written, and a table is built much faster than it is
+        compressed and written, so the next table is only taken from jobs once a worker is free. Pass a generator that
+        builds each table when asked, then only about max_workers tables are in memory at once
+    :param jobs: iterable of tuples, arguments of write_factor for each table
+    :param total: int, number of tables, for the progress bar
+    :param max_workers: int, number of worker processes (default os.cpu_count())
+    """
+
+    max_workers = max_workers or os.cpu_count() or 1
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, tqdm(total=total) as progress:
+        pending = set()
+        while True:
+            if len(pending) >= max_workers:
+                # wait until a table is written before building the next one
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()  # raise the exception from worker process if there is any
+                    progress.update()
+
+            job = next(jobs, None)
+            if job is None:
+                break
+            pending.add(executor.submit(write_factor, *job))
+
+        for future in as_completed(pending):
+            future.result()
+            progress.update()
@@ -1,11 +1,12 @@
 __author__ = 'Lingsong Zeng'
 
 from datetime import datetime
-from tqdm import tqdm
 import pandas as pd
+import numpy as np
 import os
 from function.read_data_config import ReadConfig
 from function.read_index_columns import ReadIndex
+from factor_utils import write_factor
 
 
 class FloatVolume:
@@ -27,12 +28,22 @@ class FloatVolume:
                ...    |    ...    |    ...    |    ...    |
     """
 
-    def __init__(self):
-        """Initialize the class"""
+    def __init__(self, index: list = None, column: list = None):
+        """
+        Initialize the class
+        :param index: list, the date list constructed before, read by ReadIndex if not given
+        :param column: list, the stock list constructed before, read by ReadIndex if not given
+        Note:
+            pass index and column read once when running several classes together, so they are not read again
+        """
 
-        ri = ReadIndex()
-        self.index = ri.read_index()     # For the date list we constructed before
-        self.column = ri.read_columns()  # For the stock list we constructed before
+        if index is None or column is None:
+            ri = ReadIndex()
+            index = ri.read_index() if index is None else index
+            column = ri.read_columns() if column is None else column
+        self.index = index    # For the date list we constructed before
+        self.column = column  # For the stock list we constructed before
+        self.code_str = ', '.join("'{}'".format(code) for code in self.column)  # only read stocks in self.column
 
         rc = ReadConfig()
         self.db = rc.read_wind_mysql()
@@ -41,26 +52,31 @@ class FloatVolume:
         self.data_path = os.path.abspath(os.path.join(data_path, 'ASHARECAPITALIZATION'))
         if not os.path.exists(self.data_path):
             os.makedirs(self.data_path)
+        self.file_path = os.path.join(self.data_path, 'float_volume.hdf5')  # self.data_path is already absolute
 
     def read_data_before_begin_date(self, begin_date: str) -> pd.DataFrame:
         """
         Read data one date before the begin_date
+        Note:
+            the latest record of each stock is picked by ROW_NUMBER() (MySQL 8+) in one scan, instead of joining the
+            max(CHANGE_DT) of each stock back to the table; an index on (WIND_CODE, CHANGE_DT) lets MySQL read the
+            records of each stock in order
         :param begin_date: str
         :return: pd.DataFrame
         """
 
         sql = """
-        SELECT f.WIND_CODE, f.CHANGE_DT, f.FLOAT_A_SHR
+        SELECT WIND_CODE, CHANGE_DT, FLOAT_A_SHR
         FROM (
-            SELECT WIND_CODE, max(CHANGE_DT) as last_CHANGE_DT
+            SELECT WIND_CODE, CHANGE_DT, FLOAT_A_SHR,
+                   ROW_NUMBER() OVER (PARTITION BY WIND_CODE ORDER BY CHANGE_DT DESC) AS rn
             FROM wind.ASHARECAPITALIZATION
-            WHERE CHANGE_DT <= {} AND WIND_CODE NOT REGEXP '^[a-zA-Z]'
-            group by WIND_CODE
-        ) AS x inner join wind.ASHARECAPITALIZATION as f on f.WIND_CODE = x.WIND_CODE and f.CHANGE_DT = x.last_CHANGE_DT
-        WHERE FLOAT_A_SHR > 0;
-        """.format(begin_date)
+            WHERE CHANGE_DT <= %s AND WIND_CODE NOT REGEXP '^[a-zA-Z]' AND WIND_CODE IN ({})
+        ) AS x
+        WHERE rn = 1 AND FLOAT_A_SHR > 0;
+        """.format(self.code_str)
 
-        return pd.read_sql(sql, self.db)
+        return pd.read_sql(sql, self.db, params=(begin_date,))
 
     def read_data_after_begin_date(self, begin_date: str) -> pd.DataFrame:
         """
@@ -72,10 +88,10 @@ class FloatVolume:
         sql = """
         SELECT WIND_CODE, CHANGE_DT, FLOAT_A_SHR
         FROM wind.ASHARECAPITALIZATION
-        WHERE CHANGE_DT >= {} AND WIND_CODE NOT REGEXP '^[a-zA-Z]' AND FLOAT_A_SHR > 0;
-        """.format(begin_date)
+        WHERE CHANGE_DT >= %s AND WIND_CODE NOT REGEXP '^[a-zA-Z]' AND WIND_CODE IN ({}) AND FLOAT_A_SHR > 0;
+        """.format(self.code_str)
 
-        return pd.read_sql(sql, self.db)
+        return pd.read_sql(sql, self.db, params=(begin_date,))
 
     def read_data(self, begin_date: str = '20160101') -> pd.DataFrame:
         """
@@ -86,7 +102,9 @@ class FloatVolume:
 
         data_a = self.read_data_before_begin_date(begin_date)
         data_b = self.read_data_after_begin_date(begin_date)
-        return data_a.append(data_b, ignore_index=True)
+        data = pd.concat([data_a, data_b], ignore_index=True, copy=False)
+        data['WIND_CODE'] = data['WIND_CODE'].astype('category')  # store each stock code only once
+        return data
 
     def read_exist_data(self) -> object:
         """
@@ -94,8 +112,33 @@ class FloatVolume:
         :return: object
         """
 
-        data_path = os.path.abspath(os.path.join(self.data_path, 'float_volume.hdf5'))
-        return pd.read_hdf(data_path, key='float_volume')
+        return pd.read_hdf(self.file_path, key='float_volume')
+
+    def build_table(self, data: pd.DataFrame, index: list) -> pd.DataFrame:
+        """
+        Build the float volume table, a changed volume is filled forward until the next change
+        :param data: pd.DataFrame, data from read_data
+        :param index: list, dates of the table
+        :return: pd.DataFrame, index -> index, columns -> self.column
+        """
+
+        # records in order of CHANGE_DT (stable, so the last record wins if one stock changes more than once on a date)
+        data = data.sort_values('CHANGE_DT', kind='mergesort')
+
+        # a volume takes effect from the first date on or after its CHANGE_DT, records before the first date of the
+        # table (from read_data_before_begin_date) take effect from the first date
+        date_pos = pd.Index(index).searchsorted(data.CHANGE_DT.values)
+        code_pos = pd.Index(self.column).get_indexer(data.WIND_CODE)
+        found = (date_pos < len(index)) & (code_pos >= 0)  # drop changes out of the table
+
+        # fill a preallocated array by position: the largest record number up to a date is the latest change of that
+        # stock, got by a cumulative max along dates (-1 if there is no change yet)
+        latest = np.full((len(index), len(self.column)), -1)
+        np.maximum.at(latest, (date_pos[found], code_pos[found]), np.arange(len(data))[found])
+        latest = np.maximum.accumulate(latest, axis=0)
+        value = np.where(latest >= 0, data.FLOAT_A_SHR.values[latest], np.nan)
+
+        return pd.DataFrame(value, index=index, columns=self.column)
 
     def rewrite_data(self):
         """Re-format the data from wind.ASHARECAPITALIZATION"""
@@ -103,76 +146,17 @@ class FloatVolume:
         # float_a_shr from wind.ASHARECAPITALIZATION
         float_a_shr = self.read_data()
 
-        main_dict = {}
-        stock_dict = {}
-
-        # main_dict = {
+        # main_dict:
         #
-        #     '600373.SH': {'20160104': 118568.1515,
-        #                   '20160105': 118568.1515,    -> stock_dict
-        #                   '20160106': 118568.1515,
-        #                   ......}
-        #
-        #     '300557.SZ': {'20161101': 1400.0,
-        #                   '20161102': 1400.0,         -> stock_dict
-        #                   '20161103': 1400.0,
-        #                   ......}
-        #
-        #                   ......                   }
-
-        float_a_shr = float_a_shr.sort_values(['WIND_CODE', 'CHANGE_DT']).to_dict('records')
-        pre_record_ = float_a_shr[0]  # previous object in loop, for defining the date interval
-        index_iter = iter(self.index)
-
-        for record_ in tqdm(float_a_shr[1:]):
-
-            # loop content:
-            #
-            # [{'WIND_CODE': '000301.SZ', 'CHANGE_DT': '20090611', 'FLOAT_A_SHR': 121823.6445},  -> pre_record_
-            #  {'WIND_CODE': '000301.SZ', 'CHANGE_DT': '20180903', 'FLOAT_A_SHR': 121823.6445},  -> record_
-            #  {'WIND_CODE': '000301.SZ', 'CHANGE_DT': '20200630', 'FLOAT_A_SHR': 121820.0945},
-            #   ......                                                                          ]
-
-            code_1, date_1, value_1 = pre_record_.values()
-            code_2, date_2, value_2 = record_.values()
-
-            if code_1 != code_2:  # if pre_record_ and record_ are not the same stock
-
-                # fill the rest by using the last value we have
-                for index in index_iter:
-                    stock_dict[index] = value_1
-
-                # insert stock_dict into main_dict then empty stock_dict
-                main_dict[code_1] = stock_dict.copy()
-                stock_dict.clear()
-                index_iter = iter(self.index)  # reset iterator
-
-            else:
-                # loop through index, insert value_1 as its value if index in [date_1, date_2)
-                for index in index_iter:
-                    if index < date_1:
-                        continue
-                    elif index < date_2:
-                        stock_dict[index] = value_1
-                    elif index == date_2:
-                        stock_dict[index] = value_2
-                    else:
-                        # else we reset iterator from the break point INCLUDING the index at break point, then break
-                        index_iter = iter(self.index[self.index.index(index):])
-                        break
-
-            pre_record_ = record_
-
-        # Since we are inserting pre_record_ everytime, there is one more record_ left to be insert
-        for index in index_iter:
-            stock_dict[index] = pre_record_['FLOAT_A_SHR']
-        main_dict[pre_record_['WIND_CODE']] = stock_dict.copy()
-
-        main_dict = pd.DataFrame(main_dict, columns=self.column)
+        #              | 600373.SH | 300557.SZ | ...
+        #    ----------|-----------|-----------|-----
+        #     20160104 |118568.1515|    nan    |
+        #     20160105 |118568.1515|    nan    | ...
+        #       ...    |    ...    |    ...    |
+        main_dict = self.build_table(float_a_shr, self.index)
 
         # store data as hdf5 file
-        data_path = os.path.abspath(os.path.join(self.data_path, 'float_volume.hdf5'))
-        main_dict.to_hdf(data_path, key='float_volume')
+        write_factor(main_dict, self.file_path, 'float_volume')
         print("\nFinished rewriting data")
 
     def update_data(self):
@@ -185,7 +169,7 @@ class FloatVolume:
 
         # exist_data from local
         exist_data = self.read_exist_data()
-        new_date = sorted(list(set(self.index) - set(exist_data.index)))
+        new_date = pd.Index(self.index).difference(exist_data.index).sort_values().tolist()
 
         # len(new_date) == 0 means no need to update so we end the function
         if len(new_date) == 0:
@@ -194,56 +178,11 @@ class FloatVolume:
 
         new_data = self.read_data(new_date[0])
 
-        update = {}
-        stock_dict = {}
-
-        index_iter = iter(new_date)  # we don't have to loop through the entire index but just new dates
-        new_data = new_data.sort_values(['WIND_CODE', 'CHANGE_DT']).to_dict('records')
-        pre_record_ = new_data[0]  # previous object in loop, for defining the date interval
-
-        for record_ in tqdm(new_data[1:]):
-
-            code_1, date_1, value_1 = pre_record_.values()
-            code_2, date_2, value_2 = record_.values()
-
-            if code_1 != code_2:  # if pre_record_ and record_ are not the same stock
-
-                # fill the rest by using the last value we have
-                for index in index_iter:
-                    stock_dict[index] = value_1
-
-                # insert stock_dict into main_dict then empty stock_dict
-                update[code_1] = stock_dict.copy()
-                stock_dict.clear()
-                index_iter = iter(self.index)  # reset iterator
-
-            else:
-                # loop through index, insert value_1 as its value if index in [date_1, date_2)
-                for index in index_iter:
-                    if index < date_1:
-                        continue
-                    elif index < date_2:
-                        stock_dict[index] = value_1
-                    elif index == date_2:
-                        stock_dict[index] = value_2
-                    else:
-                        # else we reset iterator from the break point INCLUDING the index at break point, then break
-                        index_iter = iter(self.index[self.index.index(index):])
-                        break
-
-            pre_record_ = record_
-
-        # Since we are inserting pre_record_ everytime, there is one more record_ left to be insert
-        for index in index_iter:
-            stock_dict[index] = pre_record_['FLOAT_A_SHR']
-
-        update[pre_record_['WIND_CODE']] = stock_dict.copy()
-        update = pd.DataFrame(update, columns=self.column)
-        exist_data = exist_data.append(update)
+        update = self.build_table(new_data, new_date)  # we don't have to fill the entire index but just new dates
+        exist_data = pd.concat([exist_data, update], copy=False)
 
         # store data as hdf5 file
-        data_path = os.path.abspath(os.path.join(self.data_path, 'float_volume.hdf5'))
-        exist_data.to_hdf(data_path, key='float_volume')
+        write_factor(exist_data, self.file_path, 'float_volume')
         print("\nFinished updating data")
 
 